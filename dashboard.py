@@ -1,12 +1,13 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import col, sum as spark_sum, trim, regexp_replace, when
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import os
-import sys
-import json
+import importlib.util
 from datetime import datetime
+from functools import partial
 from io import BytesIO
 
 st.set_page_config(
@@ -14,74 +15,193 @@ st.set_page_config(
     layout="wide"
 )
 
-@st.cache_resource
-def init_spark():
-    spark = SparkSession.builder \
-        .appName("HIV_Jabar_BigData_Analytics") \
-        .master("local[*]") \
-        .config("spark.ui.showConsoleProgress", "false") \
-        .getOrCreate()
-    return spark
-try:
-    spark = init_spark()
-except Exception as e:
-    st.error("Spark gagal dijalankan. Periksa instalasi Java dan Spark.")
-    st.exception(e)
-    sys.exit(1)
+# CSS statis halaman analisis, tidak ikut diformat ulang bersama f-string dinamis
+ANALISIS_STYLE = """
+    <style>
+        h4 {
+            font-size: 16px;
+            font-weight: bold;
+            margin: 12px 0 8px 0;
+            color: #1f77b4;
+        }
+        p {
+            font-size: 16px;
+            text-align: justify;
+            margin: 8px 0;
+            line-height: 1.6;
+        }
+        ol {
+            font-size: 16px;
+            font-weight: bold;
+            margin: 8px 0;
+            padding-left: 1.5em;
+        }
+        ol li {
+            font-size: 16px;
+            font-weight: normal;
+            text-align: justify;
+            margin: 6px 0;
+            line-height: 1.6;
+        }
+        strong {
+            font-weight: bold;
+        }
+        a {
+            color: #0066cc;
+            text-decoration: none;
+        }
+        a:hover {
+            text-decoration: underline;
+        }
+    </style>
+"""
 
-@st.cache_resource
-def load_data():
-    csv_path = os.path.join(
-        os.path.dirname(__file__),
-        "dinkes_od_17570_jumlah_kasus_hiv_berdasarkan_kelompok_umur_v1_data.csv"
-    )
-    if not os.path.exists(csv_path):
-        raise FileNotFoundError("File CSV tidak ditemukan.")
-    df = spark.read.csv(
+CSV_PATH = os.path.join(
+    os.path.dirname(__file__),
+    "dinkes_od_17570_jumlah_kasus_hiv_berdasarkan_kelompok_umur_v1_data.csv"
+)
+
+desired_age_order = ['0-4', '5-14', '15-19', '20-24', '25-49', '≥50']
+
+# Cache dikunci pada (path, mtime) sehingga hanya dibaca ulang saat file berubah
+@st.cache_data(show_spinner=False)
+def load_data(csv_path, csv_mtime):
+    df = pd.read_csv(
         csv_path,
-        header=True,
-        inferSchema=True
+        engine="pyarrow",
+        dtype={
+            "id": "int32",
+            "kode_provinsi": "int16",
+            "nama_provinsi": "string",
+            "kode_kabupaten_kota": "int16",
+            "nama_kabupaten_kota": "string",
+            "kelompok_umur": "string",
+            "jenis_kelamin": "string",
+            "jumlah_kasus": "int64",
+            "satuan": "string",
+            "tahun": "int16",
+        }
     )
-    df = df.withColumn(
-    "Kelompok_Umur",
-    when(trim(col("Kelompok_Umur")).rlike(">=50|≥50|â‰¥50"), "≥50")
-    .when(trim(col("Kelompok_Umur")).rlike("0.?4"), "0-4")
-    .when(trim(col("Kelompok_Umur")).rlike("5.?14|14-May"), "5-14")
-    .when(trim(col("Kelompok_Umur")).rlike("15.?19"), "15-19")
-    .when(trim(col("Kelompok_Umur")).rlike("20.?24"), "20-24")
-    .when(trim(col("Kelompok_Umur")).rlike("25.?49"), "25-49")
-    .otherwise(trim(col("Kelompok_Umur")))
-)
-    df = df \
-        .withColumnRenamed("nama_kabupaten_kota", "Kabupaten_Kota") \
-        .withColumnRenamed("jumlah_kasus", "Jumlah_Kasus") \
-        .withColumnRenamed("kelompok_umur", "Kelompok_Umur") \
-        .withColumnRenamed("jenis_kelamin", "Jenis_Kelamin") \
-        .withColumnRenamed("tahun", "Tahun")
+    df = df.rename(columns={
+        "nama_kabupaten_kota": "Kabupaten_Kota",
+        "jumlah_kasus": "Jumlah_Kasus",
+        "kelompok_umur": "Kelompok_Umur",
+        "jenis_kelamin": "Jenis_Kelamin",
+        "tahun": "Tahun",
+    })
+    df["Jumlah_Kasus"] = pd.to_numeric(df["Jumlah_Kasus"], downcast="unsigned")
+    umur = df["Kelompok_Umur"].str.strip()
+    df["Kelompok_Umur"] = pd.Series(
+        np.select(
+            [
+                umur.str.contains(r">=50|≥50|â‰¥50", na=False),
+                umur.str.contains(r"0.?4", na=False),
+                umur.str.contains(r"5.?14|14-May", na=False),
+                umur.str.contains(r"15.?19", na=False),
+                umur.str.contains(r"20.?24", na=False),
+                umur.str.contains(r"25.?49", na=False),
+            ],
+            ["≥50", "0-4", "5-14", "15-19", "20-24", "25-49"],
+            default=umur
+        ),
+        index=df.index,
+        dtype="string"
+    )
+    # Kategori berurutan sekali di sini agar groupby langsung menghasilkan urutan umur yang benar
+    extra_ages = sorted(set(df["Kelompok_Umur"].dropna().unique()) - set(desired_age_order))
+    df["Kelompok_Umur"] = pd.Categorical(
+        df["Kelompok_Umur"],
+        categories=desired_age_order + extra_ages,
+        ordered=True
+    )
+    df["Kabupaten_Kota"] = df["Kabupaten_Kota"].astype("category")
     return df
+
+@st.cache_data(show_spinner=False)
+def load_filter_options(csv_path, csv_mtime):
+    df = load_data(csv_path, csv_mtime)
+    # np.unique sudah mengurutkan, dan kategori kota sudah unik serta terurut sejak load_data
+    list_tahun = tuple(np.unique(df["Tahun"].to_numpy())[::-1].tolist())
+    list_kota = tuple(df["Kabupaten_Kota"].cat.categories.tolist())
+    return list_tahun, list_kota
+
+# Hasil filter dimaterialisasi sekali per kombinasi (tahun, kota) dan dipakai ulang antar rerun
+@st.cache_data(show_spinner=False)
+def filter_data(csv_path, csv_mtime, tahun, kota_tuple):
+    df = load_data(csv_path, csv_mtime)
+    return df[
+        (df["Tahun"] == tahun) &
+        (df["Kabupaten_Kota"].isin(kota_tuple))
+    ].reset_index(drop=True)
+
+# Kubus agregat (tahun x kota x umur x gender) dihitung sekali, widget cukup mengiris hasil kecil ini
+@st.cache_data(show_spinner=False)
+def load_cube(csv_path, csv_mtime):
+    df = load_data(csv_path, csv_mtime)
+    return df \
+        .groupby(["Tahun", "Kabupaten_Kota", "Kelompok_Umur", "Jenis_Kelamin"], observed=True, as_index=False)["Jumlah_Kasus"].sum()
+
+# Tren tidak bergantung pada tahun, jadi cukup dihitung ulang saat pilihan kota berubah
+@st.cache_data(show_spinner=False)
+def compute_trend(csv_path, csv_mtime, kota_tuple):
+    df_cube = load_cube(csv_path, csv_mtime)
+    df_trend = df_cube[df_cube["Kabupaten_Kota"].isin(kota_tuple)] \
+        .groupby("Tahun", as_index=False)["Jumlah_Kasus"].sum() \
+        .rename(columns={"Jumlah_Kasus": "Total"})
+    # Nilai tahun sebelumnya dan persentase YoY ikut di-cache bersama trennya
+    df_trend["Total_Sebelumnya"] = df_trend["Total"].shift()
+    df_trend["YoY"] = df_trend["Total"].pct_change() * 100
+    return df_trend
+
+# Figure Plotly di-cache sebagai dict, dibangun ulang hanya saat agregatnya berubah
+@st.cache_data(show_spinner=False)
+def build_umur_fig(df_umur, age_category_order):
+    return px.bar(
+        df_umur,
+        x="Kelompok_Umur",
+        y="Total",
+        text_auto=True,
+        color="Kelompok_Umur",
+        category_orders={"Kelompok_Umur": list(age_category_order)},
+        template="plotly_white"
+    ).to_dict()
+
+@st.cache_data(show_spinner=False)
+def build_gender_fig(df_gender):
+    return px.pie(
+        df_gender,
+        names="Jenis_Kelamin",
+        values="Total",
+        hole=0.4,
+        template="plotly_white"
+    ).to_dict()
+
+@st.cache_data(show_spinner=False)
+def build_trend_fig(df_trend):
+    fig_trend = px.line(
+        df_trend,
+        x="Tahun",
+        y="Total",
+        markers=True,
+        template="plotly_dark",
+        line_shape="linear"
+    )
+    fig_trend.update_traces(line=dict(color="red", width=3), marker=dict(size=8, color="red"))
+    fig_trend.update_layout(yaxis_title="Total_Kasus", xaxis_title="Tahun", showlegend=False)
+    return fig_trend.to_dict()
 try:
-    df_spark = load_data()
+    if not os.path.exists(CSV_PATH):
+        raise FileNotFoundError("File CSV tidak ditemukan.")
+    csv_mtime = os.path.getmtime(CSV_PATH)
+    df_cube = load_cube(CSV_PATH, csv_mtime)
 except Exception as e:
     st.error("Gagal memuat data.")
     st.exception(e)
-    sys.exit(1)
+    st.stop()
 
 st.sidebar.image("https://upload.wikimedia.org/wikipedia/commons/thumb/9/99/Coat_of_arms_of_West_Java.svg/250px-Coat_of_arms_of_West_Java.svg.png", width=100)
 st.sidebar.header("Filter Data")
-list_tahun = [
-    row["Tahun"]
-    for row in (df_spark.select("Tahun")
-                .distinct()
-                .sort("Tahun", ascending=False)
-                .collect())
-]
-list_kota = [
-    row["Kabupaten_Kota"]
-    for row in (df_spark.select("Kabupaten_Kota")
-                .distinct()
-                .sort("Kabupaten_Kota")
-                .collect())
-]
+list_tahun, list_kota = load_filter_options(CSV_PATH, csv_mtime)
 
 tahun_pilih = st.sidebar.selectbox("Tahun", list_tahun)
 kota_pilih = st.sidebar.multiselect(
@@ -89,11 +209,13 @@ kota_pilih = st.sidebar.multiselect(
     list_kota,
     default=list_kota
 )
-filtered_spark = df_spark.filter(
-    (col("Tahun") == tahun_pilih) &
-    (col("Kabupaten_Kota").isin(kota_pilih))
-)
-if filtered_spark.count() == 0:
+kota_key = tuple(sorted(kota_pilih))
+cube_pilih = df_cube[
+    (df_cube["Tahun"] == tahun_pilih) &
+    (df_cube["Kabupaten_Kota"].isin(kota_pilih))
+]
+n_rows = len(cube_pilih)
+if n_rows == 0:
     st.warning("Data tidak tersedia untuk filter tersebut.")
     st.stop()
 
@@ -101,12 +223,6 @@ if filtered_spark.count() == 0:
 st.sidebar.divider()
 st.sidebar.subheader("Download Data")
 
-# Convert filtered Spark DataFrame to pandas for export
-try:
-    df_filtered_pd = filtered_spark.toPandas()
-except Exception:
-    df_filtered_pd = pd.DataFrame()
-
 # Format selector (menyerupai dropdown 'Unduh' lalu pilih format)
 format_choice = st.sidebar.selectbox(
     "Pilih Format Unduh",
@@ -118,84 +234,59 @@ format_choice = st.sidebar.selectbox(
 date_str = datetime.now().strftime('%Y%m%d')
 base_name = f"dinkes_hiv_jabar_{tahun_pilih}_filtered_{date_str}"
 
-download_data = None
-download_mime = None
-download_ext = None
+download_formats = {
+    "CSV": ("text/csv", "csv"),
+    "Excel": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+    "JSON": ("application/json", "json"),
+}
+download_mime, download_ext = download_formats[format_choice]
 
-if format_choice == "CSV":
-    csv_buffer = BytesIO()
-    df_filtered_pd.to_csv(
-    csv_buffer,
-    index=False,
-    encoding="utf-8-sig"
-)
-    csv_buffer.seek(0)
-    download_data = csv_buffer.getvalue()
-    download_mime = "text/csv"
-    download_ext = "csv"
-elif format_choice == "Excel":
-    try:
+# Data terfilter dan byte file baru dibuat saat tombol Unduh diklik, bukan di setiap rerun
+def build_download_data(csv_path, csv_mtime, tahun, kota_tuple, format_choice):
+    df = filter_data(csv_path, csv_mtime, tahun, kota_tuple)
+    if format_choice == "CSV":
+        csv_buffer = BytesIO()
+        # BOM ditulis manual agar tetap kompatibel dengan Excel seperti utf-8-sig
+        csv_buffer.write(b"\xef\xbb\xbf")
+        pacsv.write_csv(
+            pa.Table.from_pandas(df, preserve_index=False),
+            csv_buffer,
+            pacsv.WriteOptions(include_header=True)
+        )
+        return csv_buffer.getvalue()
+    if format_choice == "Excel":
         excel_buffer = BytesIO()
-        df_filtered_pd.to_excel(excel_buffer, index=False, sheet_name="Data")
-        excel_buffer.seek(0)
-        download_data = excel_buffer.getvalue()
-        download_mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        download_ext = "xlsx"
-    except Exception:
-        st.sidebar.warning("Excel download tidak tersedia untuk data yang dipilih")
-        download_data = None
-elif format_choice == "JSON":
-    try:
-        json_str = json.dumps(df_filtered_pd.to_dict(orient="records"), ensure_ascii=False, indent=2)
-        download_data = json_str.encode('utf-8')
-        download_mime = "application/json"
-        download_ext = "json"
-    except Exception:
-        st.sidebar.warning("JSON download tidak tersedia")
-        download_data = None
+        df.to_excel(excel_buffer, index=False, sheet_name="Data", engine="xlsxwriter")
+        return excel_buffer.getvalue()
+    json_str = df.to_json(orient="records", force_ascii=False, indent=2)
+    return json_str.encode('utf-8')
 
-if download_data is not None and download_ext is not None:
+if format_choice == "Excel" and importlib.util.find_spec("xlsxwriter") is None:
+    st.sidebar.warning("Excel download tidak tersedia untuk data yang dipilih")
+    st.sidebar.info("Pilih format yang tersedia untuk mengunduh data")
+else:
     st.sidebar.download_button(
         label="Unduh",
-        data=download_data,
+        data=partial(build_download_data, CSV_PATH, csv_mtime, tahun_pilih, kota_key, format_choice),
         file_name=f"{base_name}.{download_ext}",
         mime=download_mime,
         key="download_filtered"
     )
-else:
-    st.sidebar.info("Pilih format yang tersedia untuk mengunduh data")
 
+#Agregasi umur x gender dalam satu pass, lalu turunkan dari hasil kecilnya
+df_umur_gender = cube_pilih \
+    .groupby(["Kelompok_Umur", "Jenis_Kelamin"], observed=True, as_index=False)["Jumlah_Kasus"].sum() \
+    .rename(columns={"Jumlah_Kasus": "Total"})
 #Agregasi total kasus
-total_kasus = filtered_spark \
-    .agg(spark_sum("Jumlah_Kasus")) \
-    .collect()[0][0]
-if total_kasus is None:
-    total_kasus = 0
+total_kasus = int(df_umur_gender["Total"].sum())
 #Jumlah wilayah
-jumlah_wilayah = filtered_spark \
-    .select("Kabupaten_Kota") \
-    .distinct() \
-    .count()
+jumlah_wilayah = cube_pilih["Kabupaten_Kota"].nunique()
 #Grouping berdasarkan umur
-df_umur_spark = filtered_spark \
-    .groupBy("Kelompok_Umur") \
-    .agg(spark_sum("Jumlah_Kasus").alias("Total")) \
-    .orderBy("Kelompok_Umur")
+df_umur = df_umur_gender.groupby("Kelompok_Umur", observed=True, sort=True, as_index=False)["Total"].sum()
 #Grouping berdasarkan gender
-df_gender_spark = filtered_spark \
-    .groupBy("Jenis_Kelamin") \
-    .agg(spark_sum("Jumlah_Kasus").alias("Total"))
-df_umur = df_umur_spark.toPandas()
-df_gender = df_gender_spark.toPandas()
-desired_age_order = ['0-4', '5-14', '15-19', '20-24', '25-49', '≥50']
-if not df_umur.empty:
-    unique_ages = df_umur['Kelompok_Umur'].astype(str).unique().tolist()
-    final_order = [a for a in desired_age_order if a in unique_ages] + [a for a in unique_ages if a not in desired_age_order]
-    df_umur['Kelompok_Umur'] = pd.Categorical(df_umur['Kelompok_Umur'], categories=final_order, ordered=True)
-    df_umur = df_umur.sort_values('Kelompok_Umur')
-    age_category_order = final_order
-else:
-    age_category_order = desired_age_order
+df_gender = df_umur_gender.groupby("Jenis_Kelamin", as_index=False)["Total"].sum()
+age_category_order = df_umur["Kelompok_Umur"].cat.categories.tolist()
+if df_umur.empty:
     age_name = "N/A"
     age_total = 0
     age_pct = 0.0
@@ -209,6 +300,13 @@ try:
         kelompok_dominan = None
 except Exception:
     kelompok_dominan = None
+try:
+    gender_dom = df_gender.loc[df_gender["Total"].idxmax()]
+    gender_name = gender_dom["Jenis_Kelamin"]
+    gender_total = int(gender_dom["Total"])
+    gender_pct = (gender_total / total_kasus * 100) if total_kasus else 0.0
+except Exception:
+    gender_dom = None
 
 st.title("Dashboard Analisis Kasus HIV Di Jawa Barat")
 st.write(f"Tahun Analisis: {tahun_pilih}")
@@ -233,90 +331,44 @@ st.divider()
 kiri, kanan = st.columns(2)
 with kiri:
     st.subheader("Distribusi Kasus Berdasarkan Kelompok Umur")
-    fig_umur = px.bar(
-        df_umur,
-        x="Kelompok_Umur",
-        y="Total",
-        text_auto=True,
-        color="Kelompok_Umur",
-        category_orders={"Kelompok_Umur": age_category_order},
-        template="plotly_white"
-    )
+    fig_umur = build_umur_fig(df_umur, tuple(age_category_order))
     st.plotly_chart(fig_umur, use_container_width=True)
 
 with kanan:
     st.subheader("Proporsi Kasus Berdasarkan Jenis Kelamin")
-    fig_gender = px.pie(
-        df_gender,
-        names="Jenis_Kelamin",
-        values="Total",
-        hole=0.4,
-        template="plotly_white"
-    )
+    fig_gender = build_gender_fig(df_gender)
     st.plotly_chart(fig_gender, use_container_width=True)
 
 st.divider()
 st.subheader("Tren Kenaikan Kasus (2019-2023)")
 st.markdown("Perhatikan Lonjakan Signifikan Pasca-Pandemi (2022)")
 
-df_trend_spark = df_spark \
-    .filter(col("Kabupaten_Kota").isin(kota_pilih)) \
-    .groupBy("Tahun") \
-    .agg(spark_sum("Jumlah_Kasus").alias("Total")) \
-    .orderBy("Tahun")
-try:
-    df_trend = df_trend_spark.toPandas()
-except Exception:
-    df_trend = pd.DataFrame()
+df_trend = compute_trend(CSV_PATH, csv_mtime, kota_key)
 if df_trend.empty:
     st.info("Data tren tidak tersedia untuk pilihan filter saat ini.")
 else:
-    fig_trend = px.line(
-        df_trend,
-        x="Tahun",
-        y="Total",
-        markers=True,
-        template="plotly_dark",
-        line_shape="linear"
-    )
-    fig_trend.update_traces(line=dict(color="red", width=3), marker=dict(size=8, color="red"))
-    fig_trend.update_layout(yaxis_title="Total_Kasus", xaxis_title="Tahun", showlegend=False)
+    fig_trend = build_trend_fig(df_trend)
     st.plotly_chart(fig_trend, use_container_width=True)
 st.divider()
 
 insight_col1, insight_col2, insight_col3 = st.columns(3)
-try:
-    age_name = kelompok_dominan["Kelompok_Umur"]
-    age_total = int(kelompok_dominan["Total"])
-    age_pct = (age_total / total_kasus * 100) if total_kasus else 0
+if kelompok_dominan is not None:
     insight_col1.metric("Dominan - Kelompok Umur", f"{age_name}", delta=f"{age_total:,} kasus ({age_pct:.1f}% dari total)")
-except Exception:
+else:
     insight_col1.info("Data umur tidak tersedia")
-try:
-    gender_dom = df_gender.loc[df_gender["Total"].idxmax()]
-    gender_name = gender_dom["Jenis_Kelamin"]
-    gender_total = int(gender_dom["Total"])
-    gender_pct = (gender_total / total_kasus * 100) if total_kasus else 0
+if gender_dom is not None:
     insight_col2.metric("Dominan - Jenis Kelamin", f"{gender_name}", delta=f"{gender_total:,} kasus ({gender_pct:.1f}% dari total)")
-except Exception:
+else:
     insight_col2.info("Data gender tidak tersedia")
 try:
     top_row = df_trend.loc[df_trend["Total"].idxmax()]
-    top_year = int(top_row["Tahun"]) if str(top_row["Tahun"]).isdigit() else top_row["Tahun"]
+    top_year = int(top_row["Tahun"])
     top_total = int(top_row["Total"])
-    sorted_trend = df_trend.sort_values("Tahun")
-    years = list(sorted_trend["Tahun"])
-    vals = list(sorted_trend["Total"])
-    if top_year in years:
-        idx = years.index(top_year)
-        if idx > 0 and vals[idx-1] != 0:
-            prev = int(vals[idx-1])
-            yoy = (top_total - prev) / prev * 100
-            yoy_text = f"{yoy:.1f}% naik dari {prev:,}"
-        else:
-            yoy_text = "Tidak ada data sebelumnya"
+    if pd.notna(top_row["Total_Sebelumnya"]) and top_row["Total_Sebelumnya"] != 0:
+        prev = int(top_row["Total_Sebelumnya"])
+        yoy_text = f"{top_row['YoY']:.1f}% naik dari {prev:,}"
     else:
-        yoy_text = "-"
+        yoy_text = "Tidak ada data sebelumnya"
     insight_col3.metric("Puncak Tahun", f"{top_year}", delta=f"{top_total:,} kasus — {yoy_text}")
 except Exception:
     insight_col3.info("Data tren tidak tersedia")
@@ -330,45 +382,8 @@ with st.expander("Buka Detail Analisis", expanded=True):
         age_pct_safe = age_pct if 'age_pct' in locals() else 0.0
         gender_name_safe = gender_name if 'gender_name' in locals() else "N/A"
         gender_pct_safe = gender_pct if 'gender_pct' in locals() else 0.0
+        st.markdown(ANALISIS_STYLE, unsafe_allow_html=True)
         st.markdown(f"""
-        <style>
-            h4 {{
-                font-size: 16px;
-                font-weight: bold;
-                margin: 12px 0 8px 0;
-                color: #1f77b4;
-            }}
-            p {{
-                font-size: 16px;
-                text-align: justify;
-                margin: 8px 0;
-                line-height: 1.6;
-            }}
-            ol {{
-                font-size: 16px;
-                font-weight: bold;
-                margin: 8px 0;
-                padding-left: 1.5em;
-            }}
-            ol li {{
-                font-size: 16px;
-                font-weight: normal;
-                text-align: justify;
-                margin: 6px 0;
-                line-height: 1.6;
-            }}
-            strong {{
-                font-weight: bold;
-            }}
-            a {{
-                color: #0066cc;
-                text-decoration: none;
-            }}
-            a:hover {{
-                text-decoration: underline;
-            }}
-        </style>
-        
         <div style="padding: 10px;">
         
         <h4>1. Interpretasi Tren Tahunan</h4>